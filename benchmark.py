@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# vim: ts=4 sts=4 et sw=4
+
+# Regression benchmarks for the flair parsing and diffing hot paths
+#
+# Generates a synthetic multi-subreddit flair dataset, times reddit_get_valid_flair,
+# reddit_get_additional_flair, merge_flairs and sync_flairs against it, and exits
+# non-zero if any function exceeds its time or peak memory budget.  No reddit
+# connection is made; flairs sync_flairs would send are collected instead.
+#
+#   python benchmark.py [--subs N] [--users N] [--budget FUNC=MS[:KIB] ...]
+
+from contextlib import redirect_stdout
+from datetime import datetime
+from reddit import reddit_get_valid_flair
+from reddit import reddit_get_additional_flair
+import argparse
+import flairsync
+import io
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+# default synthetic flair scheme: merged flairs are runs of components, each optionally marked with a T
+components = ['ds1', 'ds2', 'ds3', 'bb', 'des']
+other_flairs = ['mod', 'helper', 'veteran']
+
+default_valid_flairs = r'\b(?=ds1|ds2|ds3|bb|des)(?:ds1T?)?(?:ds2T?)?(?:ds3T?)?(?:bbT?)?(?:desT?)?\b'
+default_component_flairs = r'(ds1T?)?(ds2T?)?(ds3T?)?(bbT?)?(desT?)?'
+default_valid_new_flairs = r'(?::\w+:)+'
+
+# default budgets per function as (milliseconds, peak KiB), sized for the default dataset
+default_budgets = {
+    'reddit_get_valid_flair': (200, 1024),
+    'reddit_get_additional_flair': (200, 1024),
+    'merge_flairs': (500, 12288),
+    'sync_flairs': (500, 12288),
+}
+
+
+# build a random merged flair from components
+def random_flair(rng):
+    chosen = [c for c in components if rng.random() < 0.4] or [rng.choice(components)]
+
+    return ''.join(c + ('T' if rng.random() < 0.3 else '') for c in chosen)
+
+
+# generate source_flairs in the format returned by reddit_get_all_flair
+def generate_flairs(sub_count, user_count, valid_flairs, seed=0):
+    rng = random.Random(seed)
+    users = ['user{}'.format(i) for i in range(user_count)]
+    base_flairs = dict((user, random_flair(rng)) for user in users)
+    source_flairs = {}
+
+    for s in range(sub_count):
+        sub_flairs = {}
+
+        for user in users:
+            # users are not flaired in every sub, and some flairs have drifted
+            if rng.random() < 0.3:
+                continue
+
+            flair = base_flairs[user] if rng.random() < 0.9 else random_flair(rng)
+            css_class = ' '.join([rng.choice(other_flairs), flair]) if rng.random() < 0.05 else flair
+
+            sub_flairs[user] = {
+                'valid_flair': reddit_get_valid_flair(css_class, valid_flairs),
+                'other_flair': reddit_get_additional_flair(css_class, valid_flairs),
+                'flair_text': '{} Karma'.format(rng.randint(1, 500)) if rng.random() < 0.1 else '',
+            }
+
+        source_flairs['sub{}'.format(s)] = sub_flairs
+
+    return source_flairs
+
+
+# run fn repeat times, returning the best time in ms and the peak traced memory in KiB
+def measure(fn, repeat):
+    best = None
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+
+    return best, peak
+
+
+def parse_budget(value):
+    try:
+        name, limits = value.split('=')
+        ms, kib = limits.split(':') if ':' in limits else (limits, None)
+
+        if name not in default_budgets:
+            raise ValueError('unknown function {}'.format(name))
+
+        return name, (float(ms), float(kib) if kib is not None else default_budgets[name][1])
+    except ValueError as e:
+        raise argparse.ArgumentTypeError('invalid budget {}: {}'.format(value, e))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark flair parsing and diffing.')
+    parser.add_argument('--subs', type=int, default=3, help='number of synthetic subreddits (default: 3)')
+    parser.add_argument('--users', type=int, default=20000, help='number of synthetic users (default: 20000)')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs per function, best is kept (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the dataset (default: 0)')
+    parser.add_argument('--valid-flairs', default=default_valid_flairs, help='valid_flairs regex')
+    parser.add_argument('--component-flairs', default=default_component_flairs, help='component_flairs regex')
+    parser.add_argument('--budget', type=parse_budget, action='append', default=[], metavar='FUNC=MS[:KIB]',
+                        help='override the time (and peak memory) budget of a function')
+    args = parser.parse_args(argv)
+
+    budgets = dict(default_budgets)
+    budgets.update(args.budget)
+
+    valid_flairs = re.compile(args.valid_flairs)
+    component_flairs = re.compile(args.component_flairs)
+    valid_new_flairs = re.compile(default_valid_new_flairs)
+    new_flair_map = dict((c, c) for c in components)
+
+    print('[{}] Generating {} user(s) across {} sub(s)...'
+          .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), args.users, args.subs))
+
+    source_flairs = generate_flairs(args.subs, args.users, valid_flairs, args.seed)
+    source_subs = sorted(source_flairs.keys())
+    css_classes = [' '.join([f['other_flair'], f['valid_flair']]).strip()
+                   for sub_flairs in source_flairs.values() for f in sub_flairs.values()][:args.users]
+
+    # run flairsync non-interactively, collecting flairs instead of sending them to reddit
+    sent = []
+    flairsync.debug_level = ''
+    flairsync.config = flairsync.FlairSyncConfig(
+        debug_level='', mode='single', loop_time=0, operation='automatic', progress=False,
+        source_subs=source_subs, valid_flairs=valid_flairs, ignore_list=None, kill_list=None,
+        new_subs=source_subs, valid_new_flairs=valid_new_flairs, new_flair_map=new_flair_map,
+        component_flairs=component_flairs, flair_index=None,
+        client_id='', client_secret='', refresh_token='', user_agent='',
+    )
+    flairsync.reddit_set_flair = lambda r, sub_name, flairs, sync_flairs='y', debug_level='NOTICE': sent.append(len(flairs))
+
+    with redirect_stdout(io.StringIO()):
+        merged_flairs = flairsync.merge_flairs(source_subs, source_flairs, valid_flairs)
+
+    def run_sync():
+        new_flair_table = flairsync.build_new_flair_table(merged_flairs, component_flairs, new_flair_map)
+        flairsync.sync_flairs(source_subs, source_subs, source_flairs, merged_flairs, valid_flairs,
+                              new_flair_table, valid_new_flairs)
+
+    benchmarks = [
+        ('reddit_get_valid_flair', lambda: [reddit_get_valid_flair(c, valid_flairs) for c in css_classes]),
+        ('reddit_get_additional_flair', lambda: [reddit_get_additional_flair(c, valid_flairs) for c in css_classes]),
+        ('merge_flairs', lambda: flairsync.merge_flairs(source_subs, source_flairs, valid_flairs)),
+        ('sync_flairs', run_sync),
+    ]
+
+    failed = False
+
+    for name, fn in benchmarks:
+        with redirect_stdout(io.StringIO()):
+            ms, kib = measure(fn, args.repeat)
+
+        budget_ms, budget_kib = budgets[name]
+        ok = ms <= budget_ms and kib <= budget_kib
+        failed = failed or not ok
+
+        print('[{}] {:<28} {:>9.1f} ms (budget {:.0f})  {:>9.1f} KiB peak (budget {:.0f})  {}'
+              .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), name, ms, budget_ms, kib, budget_kib,
+                      'ok' if ok else 'OVER BUDGET'))
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# vim: ts=4 sts=4 et sw=4
+
+# Entry point for running either bot:
+#
+#   python -m darksoulsbots flairsync|karmaflair [--config FILE] [--mode single|continuous | --profile [DIR] [--profile-memory]]
+#
+# Only the selected bot is imported, so e.g. flairsync runs never load psycopg2
+
+from datetime import datetime
+import argparse
+import cProfile
+import importlib
+import os
+import pstats
+import sys
+import tracemalloc
+
+bots = ('flairsync', 'karmaflair')
+
+
+# run a single pass of bot under cProfile, or tracemalloc if memory is set, writing reports to report_dir.
+# The two are never combined, as tracing allocations skews cProfile timings.
+def profile_bot(bot, bot_name, cfg_filename, report_dir, memory=False):
+    report_name = os.path.join(report_dir, '{}-{}-{}'.format(bot_name, 'memory' if memory else 'time',
+                                                            datetime.now().strftime('%Y%m%d-%H%M%S')))
+    profiler = cProfile.Profile()
+
+    if memory:
+        tracemalloc.start()
+    else:
+        profiler.enable()
+
+    try:
+        bot.main(cfg_filename, 'single')
+    finally:
+        os.makedirs(report_dir, exist_ok=True)
+
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            with open(report_name + '.txt', 'w') as report:
+                report.write('Peak traced memory: {:.1f} KiB, at exit: {:.1f} KiB\n\n'.format(peak / 1024, current / 1024))
+
+                report.write('Top allocations by line:\n')
+                for stat in snapshot.statistics('lineno')[:25]:
+                    report.write('{}\n'.format(stat))
+
+            print('[{}] Memory profile written to {}.txt'
+                  .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), report_name))
+        else:
+            profiler.disable()
+            profiler.dump_stats(report_name + '.prof')
+
+            with open(report_name + '.txt', 'w') as report:
+                stats = pstats.Stats(profiler, stream=report)
+                stats.sort_stats('cumulative').print_stats(50)
+
+            print('[{}] Profile written to {}.prof and {}.txt'
+                  .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), report_name, report_name))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='darksoulsbots', description='Various bots for reddit.')
+    parser.add_argument('bot', choices=bots, help='bot to run')
+    parser.add_argument('--config', help='ini file to read (default: <bot>.ini)')
+    parser.add_argument('--mode', choices=('single', 'continuous'),
+                        help='override the mode set in the ini file, continuous runs as a long-lived daemon')
+    parser.add_argument('--profile', nargs='?', const='profile', metavar='DIR',
+                        help='profile a single pass with cProfile, writing reports to DIR (default: profile)')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='with --profile, trace allocations with tracemalloc instead of timing with cProfile')
+    args = parser.parse_args(argv)
+
+    if args.profile is not None and args.mode is not None:
+        parser.error('--mode cannot be used with --profile, which always runs a single pass')
+
+    if args.profile_memory and args.profile is None:
+        parser.error('--profile-memory requires --profile')
+
+    sys.stdout.reconfigure(line_buffering=True)
+
+    bot = importlib.import_module(args.bot)
+    cfg_filename = args.config if args.config is not None else args.bot + '.ini'
+
+    if args.profile is not None:
+        profile_bot(bot, args.bot, cfg_filename, args.profile, args.profile_memory)
+    else:
+        bot.main(cfg_filename, args.mode)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+from datetime import datetime
+import sqlite3
+import sys
+import time
+
+
+###
+# Flair Index Helpers
+###
+#
+# A local SQLite store of the last known flair for each subreddit/user, shared
+# by FlairSync and KarmaFlair so each sees flair the other has set without
+# another API fetch.  Rows carry the time they were observed, and older
+# observations never overwrite newer ones.
+#
+# open (and create if needed) the flair index at path
+def flair_index_open(path):
+    try:
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS flair ('
+                     ' subreddit TEXT NOT NULL,'
+                     ' user TEXT NOT NULL,'
+                     ' flair_css_class TEXT NOT NULL,'
+                     ' flair_text TEXT NOT NULL,'
+                     ' updated REAL NOT NULL,'
+                     ' PRIMARY KEY (subreddit, user))')
+        conn.commit()
+    except sqlite3.Error as e:
+        sys.stderr.write('[{}] [ERROR]: Unable to open flair index {}: {}\n'
+                         .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), path, e))
+        sys.exit(1)
+
+    return conn
+
+
+# get indexed flair, with the time it was observed, for a single user, or None if the user is not indexed
+def flair_index_get(conn, sub_name, user):
+    row = conn.execute('SELECT flair_css_class, flair_text, updated FROM flair WHERE subreddit=? AND user=?',
+                       (sub_name.lower(), user)).fetchone()
+
+    if row is None:
+        return None
+
+    return {'flair_css_class': row[0], 'flair_text': row[1], 'updated': row[2]}
+
+
+# get indexed flair, with the time it was observed, for all users of a sub
+def flair_index_get_all(conn, sub_name):
+    flairs = {}
+
+    for row in conn.execute('SELECT user, flair_css_class, flair_text, updated FROM flair WHERE subreddit=?',
+                            (sub_name.lower(),)):
+        flairs[row[0]] = {'flair_css_class': row[1], 'flair_text': row[2], 'updated': row[3]}
+
+    return flairs
+
+
+# record flairs (as passed to reddit_set_flair) observed at time updated,
+# skipping any user with a more recent entry
+def flair_index_set(conn, sub_name, flairs, updated=None):
+    if updated is None:
+        updated = time.time()
+
+    with conn:
+        conn.executemany('INSERT INTO flair (subreddit, user, flair_css_class, flair_text, updated)'
+                         ' VALUES (?, ?, ?, ?, ?)'
+                         ' ON CONFLICT (subreddit, user) DO UPDATE SET'
+                         ' flair_css_class=excluded.flair_css_class, flair_text=excluded.flair_text, updated=excluded.updated'
+                         ' WHERE excluded.updated >= flair.updated',
+                         [(sub_name.lower(), flair['user'], flair['flair_css_class'] or '', flair['flair_text'] or '', updated)
+                          for flair in flairs])
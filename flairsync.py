@@ -10,7 +10,13 @@ from reddit import reddit_get_all_flair
 from reddit import reddit_get_valid_flair
 from reddit import reddit_get_additional_flair
 from reddit import reddit_set_flair
-import ConfigParser
+from reddit import read_config_file
+from reddit import read_auth_config
+from flairindex import flair_index_open
+from flairindex import flair_index_get_all
+from flairindex import flair_index_set
+from collections import namedtuple
+import configparser
 import sys
 import re
 import time
@@ -18,21 +24,17 @@ from datetime import datetime
 
 # globals
 debug_level = ''
-cfg_file = None
+config = None
 r = None
+flair_index = None
 
-
-# helper class for tee logging
-class FlushOutput(object):
-    def __init__(self):
-        self.terminal = sys.stdout
-
-    def write(self, message):
-        self.terminal.write(message)
-        self.terminal.flush()
-
-orig_stdout = sys.stdout
-sys.stdout = FlushOutput()
+# parsed and validated flairsync.ini options
+FlairSyncConfig = namedtuple('FlairSyncConfig', [
+    'debug_level', 'mode', 'loop_time', 'operation', 'progress',
+    'source_subs', 'valid_flairs', 'ignore_list', 'kill_list',
+    'new_subs', 'valid_new_flairs', 'new_flair_map', 'component_flairs',
+    'flair_index', 'client_id', 'client_secret', 'refresh_token', 'user_agent',
+])
 
 
 # merge valid flairs from source_subs
@@ -78,22 +80,21 @@ def merge_flairs(source_subs, source_flairs, valid_flairs):
                 source_flair = reddit_get_valid_flair(full_source_flair, valid_flairs)
 
                 if merged_flair != source_flair:
-                    operation = cfg_file.get('general', 'operation')
                     sync_flair = ''
 
-                    if operation != 'automatic':
+                    if config.operation != 'automatic':
                         print("[{}] Mismatched flair for User: {}, (m)erged: {}, (s)ource: {}, (c)ustom"
                               .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), key, merged_flair, source_flair))
 
                         # query user to resolve flair mismatch
-                        sync_flair = raw_input('Sync flair from (m/s/c/n)? ')
+                        sync_flair = input('Sync flair from (m/s/c/n)? ')
                     else:
                         # choose longest flair for merge
                         if len(merged_flair) < len(source_flair):
                             sync_flair = 's'
 
                     if sync_flair == 'c':
-                        merged_flairs[key] = raw_input('Enter a custom flair: ')
+                        merged_flairs[key] = input('Enter a custom flair: ')
                     elif sync_flair == 's':
                         both_count += 1
                         merged_flairs[key] = full_source_flair
@@ -109,13 +110,58 @@ def merge_flairs(source_subs, source_flairs, valid_flairs):
     return merged_flairs
 
 
-# sync merged_flairs to source_subs
-def sync_flairs(source_subs, new_subs, source_flairs, merged_flairs, valid_flairs, component_flairs, valid_new_flairs, new_flair_map, ignore_list=None, kill_list=None):
+# build new reddit emoji flair text for a single merged flair
+def get_new_flair_text(merged_flair, component_flairs, new_flair_map):
+    new_flair = []
+
+    match = component_flairs.search(merged_flair)
+    if match:
+        for m in match.groups():
+            if m is not None:
+                m_flair = m.replace('T', '').lower()
+                if m_flair in new_flair_map:
+                    new_flair.append(':' + new_flair_map[m_flair] + ':')
+                elif debug_level == 'NOTICE' or debug_level == 'DEBUG':
+                    print('[{}] [NOTICE] No new reddit flair mapped for component: {} of flair: {}'
+                          .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), m_flair, merged_flair))
+
+    return ''.join(new_flair)
+
+
+# build translation table of merged flair -> new reddit emoji flair text,
+# computed once per distinct merged flair rather than once per user
+def build_new_flair_table(merged_flairs, component_flairs, new_flair_map):
+    new_flair_table = {}
+
+    if component_flairs is None:
+        return None
+
+    for merged_flair in set(merged_flairs.values()):
+        if merged_flair != '':
+            new_flair_table[merged_flair] = get_new_flair_text(merged_flair, component_flairs, new_flair_map)
+
+    if debug_level == 'DEBUG':
+        print('[{}] [DEBUG] Built new reddit flair table for {} distinct flair(s)'
+              .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), len(new_flair_table)))
+
+    return new_flair_table
+
+
+# combine non new reddit flair text (e.g. karma) with new reddit flair text
+def get_sync_flair_text(flair_text, new_flair_text, valid_new_flairs):
+    other_flair_text = reddit_get_additional_flair(flair_text, valid_new_flairs)
+
+    return ' '.join([t for t in [other_flair_text, new_flair_text] if t != ''])
+
+
+# sync merged_flairs to source_subs, loaded is the time source_flairs were loaded
+def sync_flairs(source_subs, new_subs, source_flairs, merged_flairs, valid_flairs, new_flair_table, valid_new_flairs, ignore_list=None, kill_list=None, loaded=None):
     for source_sub in source_subs:
         print('[{}] Checking for flairs to sync to /r/{}...'
               .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), source_sub))
 
         response = []
+        new_flair_texts = {}
 
         # determine flairs to sync as flairs in merge set but not source set,
         # as well as flairs present in both sets that do not match
@@ -129,7 +175,6 @@ def sync_flairs(source_subs, new_subs, source_flairs, merged_flairs, valid_flair
                 source_flair = source_flairs[source_sub][user]['valid_flair'] if user in source_flairs[source_sub] else ''
                 other_flair = source_flairs[source_sub][user]['other_flair'] if user in source_flairs[source_sub] else ''
                 flair_text = source_flairs[source_sub][user]['flair_text'] if user in source_flairs[source_sub] else ''
-                other_flair_text = reddit_get_additional_flair(flair_text, valid_new_flairs)
                 merged_flair = merged_flairs[user]
 
                 if debug_level == 'DEBUG':
@@ -153,105 +198,127 @@ def sync_flairs(source_subs, new_subs, source_flairs, merged_flairs, valid_flair
                     row['flair_css_class'] = ' '.join([other_flair, merged_flair]) if other_flair != '' else merged_flair
 
                 new_flair_text = ''
-                if source_sub in new_subs and component_flairs is not None:
+                if new_subs is not None and source_sub in new_subs and new_flair_table is not None:
                     # add new reddit version of valid flair if available
-                    match = re.search(component_flairs, merged_flair)
-                    if match:
-                        new_flair = []
-                        for m in match.groups():
-                            if m is not None:
-                                m_flair = m.replace('T', '').lower()
-                                if m_flair in new_flair_map:
-                                    new_flair.append(':' + new_flair_map[m_flair] + ':')
-
-                        new_flair_text = ''.join(new_flair) if len(new_flair) else ''
-
-                if other_flair_text != '' or new_flair_text != '':
-                    flair_text = [t for t in [other_flair_text, new_flair_text] if t != '']
-                    row['flair_text'] = ' '.join(flair_text)
-                else:
-                    row['flair_text'] = ''
+                    new_flair_text = new_flair_table.get(merged_flair, '')
+
+                row['flair_text'] = get_sync_flair_text(flair_text, new_flair_text, valid_new_flairs)
+                new_flair_texts[user] = new_flair_text
 
                 response.append(row)
 
         # send response to reddit if there are flairs to sync
         if len(response) > 0:
-            if cfg_file.get('general', 'operation') != 'automatic':
+            if config.operation != 'automatic':
                 sync_flairs = 'n'
             else:
                 sync_flairs = 'y'
 
-            reddit_set_flair(r, source_sub, response, sync_flairs, debug_level)
+            # right before sending, prefer indexed flair text recorded since flairs were loaded,
+            # which includes any karma flair set in the meantime
+            if flair_index is not None:
+                indexed = time.time()
+                indexed_flairs = flair_index_get_all(flair_index, source_sub)
 
+                for row in response:
+                    indexed_flair = indexed_flairs.get(row['user'])
+                    if indexed_flair is not None and loaded is not None and indexed_flair['updated'] >= loaded:
+                        row['flair_text'] = get_sync_flair_text(indexed_flair['flair_text'], new_flair_texts[row['user']], valid_new_flairs)
 
-def main():
-    global cfg_file
-    global debug_level
-    global r
+            if reddit_set_flair(r, source_sub, response, sync_flairs, debug_level) and flair_index is not None:
+                # record as of when the index was read, so flair set since then is not overwritten
+                flair_index_set(flair_index, source_sub, response, indexed)
 
-    source_flairs = {}
-    merged_flairs = {}
 
-    # read ini and set config
-    cfg_file = ConfigParser.RawConfigParser()
-    while True:
-        try:
-            cfg_file.read('flairsync.ini')
-            break
-        except Exception as e:
-            sys.stderr.write('[{}] [ERROR]: {}\n'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), e))
-            sys.exit()
+# record loaded flairs to the flair index, as observed at time updated
+def index_flairs(source_subs, source_flairs, updated):
+    for source_sub in source_subs:
+        flairs = []
 
-    # required config options
-    debug_level = cfg_file.get('debug', 'level')
-    mode = cfg_file.get('general', 'mode')
-    loop_time = cfg_file.getint('general', 'loop_time')
-    source_subs = (cfg_file.get('flairsync', 'subreddits')).split(',')
-    valid_flairs = cfg_file.get('flairsync', 'valid_flairs')
+        for user, flair in source_flairs[source_sub].items():
+            flairs.append({
+                'user': user,
+                'flair_css_class': ' '.join([flair['other_flair'], flair['valid_flair']]) if flair['other_flair'] != '' else flair['valid_flair'],
+                'flair_text': flair['flair_text'],
+            })
 
-    # optional config options
-    try:
-        ignore_list = cfg_file.get('flairsync', 'ignore_list')
-        ignore_list = ignore_list.split(',')
-    except ConfigParser.NoOptionError:
-        ignore_list = None
+        flair_index_set(flair_index, source_sub, flairs, updated)
 
-    try:
-        kill_list = cfg_file.get('flairsync', 'kill_list')
-        kill_list = kill_list.split(',')
-    except ConfigParser.NoOptionError:
-        kill_list = None
 
+# parse and validate config options once at startup
+def parse_config(cfg_file):
     try:
-        new_subs = cfg_file.get('flairsync', 'new_subreddits')
-        new_subs = new_subs.split(',')
-    except ConfigParser.NoOptionError:
-        new_subs = None
+        # required config options
+        debug_level = cfg_file.get('debug', 'level')
+        mode = cfg_file.get('general', 'mode')
+        loop_time = cfg_file.getint('general', 'loop_time')
+        operation = cfg_file.get('general', 'operation')
+        source_subs = cfg_file.get('flairsync', 'subreddits').split(',')
+        valid_flairs = re.compile(cfg_file.get('flairsync', 'valid_flairs'))
+
+        # optional config options
+        ignore_list = cfg_file.get('flairsync', 'ignore_list', fallback=None)
+        kill_list = cfg_file.get('flairsync', 'kill_list', fallback=None)
+        new_subs = cfg_file.get('flairsync', 'new_subreddits', fallback=None)
+        valid_new_flairs = re.compile(cfg_file.get('flairsync', 'valid_new_flairs', fallback='a^'))  # default matches nothing
+        component_flairs = cfg_file.get('flairsync', 'component_flairs', fallback=None)
+        progress = cfg_file.getboolean('general', 'progress', fallback=False)
+        flair_index_path = cfg_file.get('general', 'flair_index', fallback=None)
+        auth = read_auth_config(cfg_file)
+
+        if cfg_file.has_section('newreddit_map'):
+            new_flair_map = dict(cfg_file.items('newreddit_map'))
+        else:
+            new_flair_map = {}
+
+        if mode not in ('single', 'continuous'):
+            raise ValueError('Invalid mode: {}'.format(mode))
+
+        if operation not in ('automatic', 'manual'):
+            raise ValueError('Invalid operation: {}'.format(operation))
+
+        return FlairSyncConfig(
+            debug_level=debug_level,
+            mode=mode,
+            loop_time=loop_time,
+            operation=operation,
+            progress=progress,
+            source_subs=source_subs,
+            valid_flairs=valid_flairs,
+            ignore_list=ignore_list.split(',') if ignore_list is not None else None,
+            kill_list=kill_list.split(',') if kill_list is not None else None,
+            new_subs=new_subs.split(',') if new_subs is not None else None,
+            valid_new_flairs=valid_new_flairs,
+            new_flair_map=new_flair_map,
+            component_flairs=re.compile(component_flairs) if component_flairs is not None else None,
+            flair_index=flair_index_path,
+            **auth
+        )
+    except (configparser.Error, re.error, ValueError) as e:
+        sys.stderr.write('[{}] [ERROR]: Invalid config: {}\n'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), e))
+        sys.exit(1)
+
+
+def main(cfg_filename='flairsync.ini', mode=None):
+    global config
+    global debug_level
+    global r
+    global flair_index
 
-    try:
-        valid_new_flairs = cfg_file.get('flairsync', 'valid_new_flairs')
-    except ConfigParser.NoOptionError:
-        valid_new_flairs = 'a^' # match nothing
+    source_flairs = {}
+    merged_flairs = {}
 
-    try:
-        new_flair_map = cfg_file.items('newreddit_map')
-        new_flair_map = dict(new_flair_map)
-    except ConfigParser.NoOptionError:
-        new_flair_map = {}
+    # read ini and set config
+    cfg_file = read_config_file(cfg_filename)
+    config = parse_config(cfg_file)
 
-    try:
-        component_flairs = cfg_file.get('flairsync', 'component_flairs')
-    except ConfigParser.NoOptionError:
-        component_flairs = None
+    if mode is not None:
+        config = config._replace(mode=mode)
 
-    try:
-        if cfg_file.getboolean('general', 'progress'):
-            progress = True
-            sys.stdout = orig_stdout
-        else:
-            progress = False
-    except ConfigParser.NoOptionError:
-        progress = False
+    debug_level = config.debug_level
+
+    if config.flair_index is not None:
+        flair_index = flair_index_open(config.flair_index)
 
     # main loop at set interval if mode is set to 'continuous'
     while True:
@@ -259,35 +326,45 @@ def main():
               .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
 
         try:
-            # login
-            r = reddit_login(cfg_file, debug_level)
+            # login once, reusing the session across passes
+            if r is None:
+                r = reddit_login(config, debug_level)
 
             # retrieve valid flairs from each sub
-            source_flairs = reddit_get_all_flair(r, source_subs, valid_flairs, debug_level, progress)
+            loaded = time.time()
+            source_flairs = reddit_get_all_flair(r, config.source_subs, config.valid_flairs, debug_level, config.progress)
+
+            if flair_index is not None:
+                index_flairs(config.source_subs, source_flairs, loaded)
 
             # build list of flairs to merge from source_subs
-            merged_flairs = merge_flairs(source_subs, source_flairs, valid_flairs)
+            merged_flairs = merge_flairs(config.source_subs, source_flairs, config.valid_flairs)
+
+            # build new reddit flair text once per distinct merged flair
+            new_flair_table = build_new_flair_table(merged_flairs, config.component_flairs, config.new_flair_map)
 
             # sync merged flairs
-            sync_flairs(source_subs, new_subs, source_flairs, merged_flairs, valid_flairs, component_flairs, valid_new_flairs, new_flair_map, ignore_list, kill_list)
+            sync_flairs(config.source_subs, config.new_subs, source_flairs, merged_flairs, config.valid_flairs,
+                        new_flair_table, config.valid_new_flairs, config.ignore_list, config.kill_list, loaded)
 
-            if mode == 'continuous':
+            if config.mode == 'continuous':
                 print('[{}] Pausing flair sync...'
                       .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
-                time.sleep(loop_time)
+                time.sleep(config.loop_time)
             else:
                 break
-        except KeyboardInterrupt, SystemExit:
+        except (KeyboardInterrupt, SystemExit):
             print('[{}] Stopping flair sync...'
                   .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
             break
         except Exception as e:
             sys.stderr.write('[{}] [ERROR]: {}\n'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), e))
 
-            if mode == 'continuous':
-                time.sleep(loop_time)
+            if config.mode == 'continuous':
+                time.sleep(config.loop_time)
             else:
                 break
 
 if __name__ == '__main__':
+    sys.stdout.reconfigure(line_buffering=True)
     main()
@@ -7,7 +7,13 @@
 
 from reddit import reddit_login
 from reddit import reddit_reply_to_comment
-import ConfigParser
+from reddit import read_config_file
+from reddit import read_auth_config
+from flairindex import flair_index_open
+from flairindex import flair_index_get
+from flairindex import flair_index_set
+from collections import namedtuple
+import configparser
 from string import Template
 import psycopg2
 import psycopg2.extras
@@ -16,27 +22,27 @@ import re
 import time
 from datetime import datetime
 import uuid
+import hashlib
+import math
 
 # globals
 debug_level = ''
-cfg_file = None
+config = None
 r = None
 sr = None
 conn = None
 cur = None
 session_id = None
+flair_index = None
+reply_filter = None
+reply_ledger = None
 
-
-# helper class for tee logging
-class FlushOutput(object):
-    def __init__(self):
-        self.terminal = sys.stdout
-
-    def write(self, message):
-        self.terminal.write(message)
-        self.terminal.flush()
-
-sys.stdout = FlushOutput()
+# parsed and validated karmaflair.ini options
+KarmaFlairConfig = namedtuple('KarmaFlairConfig', [
+    'debug_level', 'mode', 'limit', 'loop_time', 'subreddit',
+    'valid_commands', 'valid_root_flair', 'dbname', 'dbuser', 'dbtablename',
+    'flair_index', 'ledger_error_rate', 'client_id', 'client_secret', 'refresh_token', 'user_agent',
+])
 
 
 def get_reply_text(reply_type, reply_vars):
@@ -45,11 +51,84 @@ def get_reply_text(reply_type, reply_vars):
     return Template(template.read()).substitute(reply_vars)
 
 
+# bloom filter of (id, name, granter, type) keys, answers "definitely not present" locally
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+
+        self.size = max(64, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b('\x1f'.join(key).encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+# load the keys of replied rows into a bloom filter sized from their count, so that most
+# new keys can be recognised without a db round trip. Rows are read in batches through a
+# server side cursor. Keys written by this process are tracked exactly in reply_ledger.
+def load_reply_ledger():
+    global reply_filter
+    global reply_ledger
+
+    reply_filter = None
+    reply_ledger = {}
+
+    try:
+        cur.execute("SELECT count(*) FROM " + config.dbtablename + " WHERE replied=TRUE")
+        count = cur.fetchone()[0]
+        bloom = BloomFilter(count, config.ledger_error_rate)
+
+        ledger_cur = conn.cursor('reply_ledger')
+        ledger_cur.execute("SELECT id, name, granter, type FROM " + config.dbtablename + " WHERE replied=TRUE")
+
+        while True:
+            rows = ledger_cur.fetchmany(10000)
+            if not rows:
+                break
+
+            for row in rows:
+                bloom.add(row)
+
+        ledger_cur.close()
+    except Exception as e:
+        conn.rollback()
+
+        sys.stderr.write('[{}] [ERROR]: Unable to load reply ledger, checking replies against the db: {}\n'
+                         .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), e))
+        sys.stderr.flush()
+    else:
+        conn.commit()
+
+        reply_filter = bloom
+
+        if debug_level == 'NOTICE' or debug_level == 'DEBUG':
+            print('[{}] [NOTICE] Loaded {} replied key(s) into a {} KiB reply filter'
+                  .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), count, len(bloom.bits) // 1024))
+
+
 def check_for_reply(submission, name, granter, reply_type):
     replied = False
 
+    # definitely not replied if this process has not replied and the key is not in the filter,
+    # anything else is checked against the db
+    key = (submission.id, name, granter, reply_type)
+    if reply_filter is not None and not reply_ledger.get(key, False) and key not in reply_filter:
+        return True
+
     try:
-        cur.execute("SELECT session_id FROM karma WHERE id=%s AND name=%s AND granter=%s AND type=%s AND replied=TRUE",
+        cur.execute("SELECT session_id FROM " + config.dbtablename + " WHERE id=%s AND name=%s AND granter=%s AND type=%s AND replied=TRUE",
                     (submission.id, name, granter, reply_type,))
         result = cur.fetchone()
 
@@ -71,7 +150,7 @@ def check_for_reply(submission, name, granter, reply_type):
 
 def set_replied(submission, name, granter, reply_type):
     try:
-        cur.execute("INSERT INTO " + cfg_file.get('karmaflair', 'dbtablename') + " (id, name, granter, type, replied, session_id)" +
+        cur.execute("INSERT INTO " + config.dbtablename + " (id, name, granter, type, replied, session_id)" +
                     " VALUES (%s, %s, %s, %s, TRUE, %s) ON CONFLICT (id, name, granter, type) DO UPDATE SET replied=TRUE",
                     (submission.id, name, granter, reply_type, session_id,))
     except Exception as e:
@@ -82,6 +161,9 @@ def set_replied(submission, name, granter, reply_type):
     else:
         conn.commit()
 
+        if reply_ledger is not None:
+            reply_ledger[(submission.id, name, granter, reply_type)] = True
+
         if debug_level == 'NOTICE' or debug_level == 'DEBUG':
             print('[{}] [NOTICE] Message reply has been recorded to {} by {}, for submission {} of type {}'
                   .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), name, granter, submission.id, reply_type))
@@ -101,12 +183,36 @@ def handle_reply(comment, submission, name, granter, reply_type, reply_vars):
             set_replied(submission, name, granter, reply_type)
 
 
-def grant_karma(comment, parent, submission, reply_vars):
+def handle_duplicate_grant(comment, submission, name, granter, reply_vars):
+    cur.execute("SELECT session_id FROM " + config.dbtablename + " WHERE id=%s AND name=%s AND granter=%s AND type='successful_award' AND replied=TRUE",
+                (submission.id, name, granter,))
+    result = cur.fetchone()
+    conn.commit()
+
+    if result is not None and result[0] == session_id:
+        # karma has already been awarded this session, reply to this attempt
+        if debug_level == 'NOTICE' or debug_level == 'DEBUG':
+            print('[{}] [NOTICE] Karma has already been granted to {} by {}, for submission {}'
+                  .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), name, granter, submission.id))
+
+        handle_reply(comment, submission, name, granter, 'already_awarded', reply_vars)
+    else:
+        if debug_level == 'DEBUG':
+            print('[{}] [DEBUG] Reply exists for submission {}'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), submission.id))
+
+
+def grant_karma(comment, parent, submission, reply_vars, parent_refreshed=None):
     name = parent.author.name
     granter = comment.author.name
+    key = (submission.id, name, granter, 'successful_award')
+
+    # grant already written by this process, skip the insert and its unique key violation
+    if reply_ledger is not None and key in reply_ledger:
+        handle_duplicate_grant(comment, submission, name, granter, reply_vars)
+        return
 
     try:
-        cur.execute("INSERT INTO " + cfg_file.get('karmaflair', 'dbtablename') + " (id, name, granter, type, session_id)" +
+        cur.execute("INSERT INTO " + config.dbtablename + " (id, name, granter, type, session_id)" +
                     " VALUES (%s, %s, %s, 'successful_award', %s)",
                     (submission.id, name, granter, session_id,))
     except psycopg2.IntegrityError as e:
@@ -114,51 +220,53 @@ def grant_karma(comment, parent, submission, reply_vars):
 
         if e.pgcode == '23505':
             # unique key violation, potentially already granted
-            cur.execute("SELECT session_id FROM karma WHERE id=%s AND name=%s AND granter=%s AND type='successful_award' AND replied=TRUE",
-                        (submission.id, name, granter,))
-            result = cur.fetchone()
-
-            if result is not None and result[0] == session_id:
-                # karma has already been awarded this session, reply to this attempt
-                if debug_level == 'NOTICE' or debug_level == 'DEBUG':
-                    print('[{}] [NOTICE] Karma has already been granted to {} by {}, for submission {}'
-                          .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), name, granter, submission.id))
+            if reply_ledger is not None:
+                reply_ledger.setdefault(key, False)
 
-                handle_reply(comment, submission, name, granter, 'already_awarded', reply_vars)
-            else:
-                if debug_level == 'DEBUG':
-                    print('[{}] [DEBUG] Reply exists for submission {}'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), submission.id))
+            handle_duplicate_grant(comment, submission, name, granter, reply_vars)
         else:
             sys.stderr.write('[{}] [ERROR]: {}\n'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), e))
             sys.stderr.flush()
     else:
         conn.commit()
 
+        if reply_ledger is not None:
+            reply_ledger.setdefault(key, False)
+
         print('[{}] Karma successfully granted to {} by {}, for submission {}'
               .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), name, granter, submission.id))
 
         # reply and update karma flair
         handle_reply(comment, submission, name, granter, 'successful_award', reply_vars)
-        set_karma_flair(parent)
+        set_karma_flair(parent, parent_refreshed)
 
 
-def set_karma_flair(comment):
+def set_karma_flair(comment, refreshed=None):
     name = comment.author.name
 
     try:
         # get their total karma from the db
-        cur.execute("SELECT name, count(*) AS karma FROM karma WHERE name=%s AND type='successful_award' GROUP BY name", (name,))
+        cur.execute("SELECT name, count(*) AS karma FROM " + config.dbtablename + " WHERE name=%s AND type='successful_award' GROUP BY name", (name,))
         result = cur.fetchone()
 
         if result is not None and result[1]:
-            # grab their existing flair info
+            # grab their existing flair info, preferring the flair index only if it was updated after the comment was refreshed
             css_flair = comment.author_flair_css_class
+            if flair_index is not None:
+                indexed_flair = flair_index_get(flair_index, config.subreddit, name)
+                if indexed_flair is not None and (refreshed is None or indexed_flair['updated'] > refreshed):
+                    css_flair = indexed_flair['flair_css_class']
+
             karma_flair_text = str(result[1]) + " Karma"
 
             if debug_level == 'DEBUG':
                 print('[{}] [DEBUG] Setting flair text for {} to {}, with css class {}'
                       .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), name, karma_flair_text, css_flair))
             sr.flair.set(name, karma_flair_text, css_flair)
+
+            if flair_index is not None:
+                flair_index_set(flair_index, config.subreddit,
+                                [{'user': name, 'flair_css_class': css_flair, 'flair_text': karma_flair_text}])
     except Exception as e:
         conn.rollback()
 
@@ -172,7 +280,7 @@ def set_karma_flair(comment):
                   .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), name, karma_flair_text))
 
 
-def process_comment_command(command, command_type, valid_commands, comment, submission, parent=None):
+def process_comment_command(command, command_type, valid_commands, comment, submission, parent=None, parent_refreshed=None):
     if command == 'karma' and command_type == '+' and parent is not None:
         # dict of vars for template completion
         reply_vars = {
@@ -194,7 +302,7 @@ def process_comment_command(command, command_type, valid_commands, comment, subm
 
             # command must be a reply to a comment, unless excepted
             submission_flair_text = submission.link_flair_text if submission.link_flair_text is not None else ''
-            if comment.is_root and re.match(cfg_file.get('karmaflair', 'valid_root_flair'), submission_flair_text) is None:
+            if comment.is_root and config.valid_root_flair.match(submission_flair_text) is None:
                 handle_reply(comment, submission, parent.author.name, comment.author.name, 'top_level', reply_vars)
                 break
 
@@ -204,7 +312,7 @@ def process_comment_command(command, command_type, valid_commands, comment, subm
                 break
 
             # cannot grant karma to another command
-            if not comment.is_root and re.search("^([\+|-])(" + valid_commands + ")$", parent.body.lower().strip()) is not None:
+            if not comment.is_root and re.search(r"^([\+|-])(" + valid_commands + ")$", parent.body.lower().strip()) is not None:
                 handle_reply(comment, submission, parent.author.name, comment.author.name, 'award_to_command', reply_vars)
                 break
 
@@ -213,36 +321,74 @@ def process_comment_command(command, command_type, valid_commands, comment, subm
                 handle_reply(comment, submission, parent.author.name, comment.author.name, 'invalid_author', reply_vars)
                 break
 
-            grant_karma(comment, parent, submission, reply_vars)
+            grant_karma(comment, parent, submission, reply_vars, parent_refreshed)
             break
 
 
-def main():
-    global cfg_file
+# parse and validate config options once at startup
+def parse_config(cfg_file):
+    try:
+        mode = cfg_file.get('general', 'mode')
+        valid_commands = cfg_file.get('karmaflair', 'valid_commands')
+
+        # validate command regex up front, it is embedded in larger patterns later
+        re.compile(valid_commands)
+
+        ledger_error_rate = cfg_file.getfloat('karmaflair', 'ledger_error_rate', fallback=0.01)
+        if not 0 < ledger_error_rate < 1:
+            raise ValueError('Invalid ledger_error_rate: {}'.format(ledger_error_rate))
+
+        if mode not in ('single', 'continuous'):
+            raise ValueError('Invalid mode: {}'.format(mode))
+
+        return KarmaFlairConfig(
+            debug_level=cfg_file.get('debug', 'level'),
+            mode=mode,
+            limit=cfg_file.getint('general', 'limit'),
+            loop_time=cfg_file.getint('general', 'loop_time'),
+            subreddit=cfg_file.get('karmaflair', 'subreddit'),
+            valid_commands=valid_commands,
+            valid_root_flair=re.compile(cfg_file.get('karmaflair', 'valid_root_flair')),
+            dbname=cfg_file.get('karmaflair', 'dbname'),
+            dbuser=cfg_file.get('karmaflair', 'dbuser'),
+            dbtablename=cfg_file.get('karmaflair', 'dbtablename'),
+            flair_index=cfg_file.get('general', 'flair_index', fallback=None),
+            ledger_error_rate=ledger_error_rate,
+            **read_auth_config(cfg_file)
+        )
+    except (configparser.Error, re.error, ValueError) as e:
+        sys.stderr.write('[{}] [ERROR]: Invalid config: {}\n'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), e))
+        sys.stderr.flush()
+        sys.exit(1)
+
+
+def main(cfg_filename='karmaflair.ini', mode=None):
+    global config
     global debug_level
     global r
     global sr
     global conn
     global cur
     global session_id
+    global flair_index
 
     # read ini and set config
-    cfg_file = ConfigParser.RawConfigParser()
-    while True:
-        try:
-            cfg_file.read('karmaflair.ini')
-            break
-        except Exception as e:
-            sys.stderr.write('[{}] [ERROR]: {}\n'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), e))
-            sys.stderr.flush()
-            sys.exit()
+    cfg_file = read_config_file(cfg_filename)
+    config = parse_config(cfg_file)
+
+    if mode is not None:
+        config = config._replace(mode=mode)
 
-    debug_level = cfg_file.get('debug', 'level')
-    mode = cfg_file.get('general', 'mode')
-    limit = cfg_file.getint('general', 'limit')
-    loop_time = cfg_file.getint('general', 'loop_time')
-    subreddit = cfg_file.get('karmaflair', 'subreddit')
-    valid_commands = cfg_file.get('karmaflair', 'valid_commands')
+    debug_level = config.debug_level
+    mode = config.mode
+    limit = config.limit
+    loop_time = config.loop_time
+    subreddit = config.subreddit
+    valid_commands = config.valid_commands
+    command_regex = re.compile(r"^([\+|-])(" + valid_commands + ")")
+
+    if config.flair_index is not None:
+        flair_index = flair_index_open(config.flair_index)
 
     while True:
         print('[{}] Starting karma flair...'
@@ -251,11 +397,15 @@ def main():
         try:
             # connect to db
             psycopg2.extras.register_uuid()
-            conn = psycopg2.connect('dbname=' + cfg_file.get('karmaflair', 'dbname') + ' user=' + cfg_file.get('karmaflair', 'dbuser'))
+            conn = psycopg2.connect('dbname=' + config.dbname + ' user=' + config.dbuser)
             cur = conn.cursor()
 
+            # load reply ledger prefilter, only worthwhile for a long-lived comment stream
+            if mode == 'continuous':
+                load_reply_ledger()
+
             # login
-            r = reddit_login(cfg_file, debug_level)
+            r = reddit_login(config, debug_level)
             sr = r.subreddit(subreddit)
 
             # generate session id
@@ -277,7 +427,7 @@ def main():
                           .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), datetime.utcfromtimestamp(comment.created_utc), comment.author.name))
 
                 # command format is to start with a + or -
-                match = re.match("^([\+|-])(" + valid_commands + ")", comment.body.lower().strip())
+                match = command_regex.match(comment.body.lower().strip())
 
                 if match is not None and match.group(2):
                     # comment contains a valid command
@@ -287,15 +437,17 @@ def main():
                     submission = comment.submission
                     if not comment.is_root:
                         parent = comment.parent()
+                        parent_refreshed = time.time()
                         parent.refresh()
                     else:
                         parent = None
+                        parent_refreshed = None
 
                     if debug_level == 'DEBUG':
                         print('[{}] [DEBUG] Processing comment command: {}{}'
                               .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), command_type, command))
 
-                    process_comment_command(command, command_type, valid_commands, comment, submission, parent)
+                    process_comment_command(command, command_type, valid_commands, comment, submission, parent, parent_refreshed)
 
             if mode == 'continuous':
                 print('[{}] Pausing karma flair...'
@@ -305,7 +457,7 @@ def main():
                 cur.close()
                 conn.close()
                 break
-        except KeyboardInterrupt, SystemExit:
+        except (KeyboardInterrupt, SystemExit):
             cur.close()
             conn.close()
 
@@ -324,4 +476,5 @@ def main():
                 break
 
 if __name__ == '__main__':
+    sys.stdout.reconfigure(line_buffering=True)
     main()
@@ -1,27 +1,61 @@
 from datetime import datetime
+import configparser
 import sys
 import re
-from praw import Reddit
+
+
+###
+# Config Helpers
+###
+#
+# read ini file, exiting if it is missing or cannot be parsed
+def read_config_file(filename):
+    cfg_file = configparser.RawConfigParser()
+
+    try:
+        if not cfg_file.read(filename):
+            raise IOError('Unable to read config file: {}'.format(filename))
+    except (IOError, configparser.Error) as e:
+        sys.stderr.write('[{}] [ERROR]: {}\n'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), e))
+        sys.exit(1)
+
+    return cfg_file
+
+
+# read and validate the [auth] options shared by all bots
+def read_auth_config(cfg_file):
+    auth = {}
+
+    for option in ('client_id', 'client_secret', 'refresh_token', 'user_agent'):
+        auth[option] = cfg_file.get('auth', option)
+
+        if auth[option].strip() == '':
+            raise ValueError('Empty auth option: {}'.format(option))
+
+    return auth
 
 
 ###
 # Authentication Helpers
 ###
 #
-# login to reddit using OAuth w/ supplied refresh token
-def reddit_login(cfg_file, debug_level='NOTICE'):
+# login to reddit using OAuth w/ supplied refresh token, config holds the options from read_auth_config
+def reddit_login(config, debug_level='NOTICE'):
 
     if debug_level == 'NOTICE' or debug_level == 'DEBUG':
         print('[{}] [NOTICE] Logging in to Reddit...'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
 
     try:
-        r = Reddit(client_id=cfg_file.get('auth', 'client_id'),
-                   client_secret=cfg_file.get('auth', 'client_secret'),
-                   refresh_token=cfg_file.get('auth', 'refresh_token'),
-                   user_agent=cfg_file.get('auth', 'user_agent'))
+        # praw is only needed once a bot actually logs in
+        from praw import Reddit
+
+        r = Reddit(client_id=config.client_id,
+                   client_secret=config.client_secret,
+                   refresh_token=config.refresh_token,
+                   user_agent=config.user_agent)
 
     except Exception as e:
-        sys.stderr.write('[{}] [ERROR]: {}'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), e))
+        sys.stderr.write('[{}] [ERROR]: {}\n'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), e))
         sys.exit()
 
     return r
@@ -85,14 +119,14 @@ def reddit_get_all_flair(r, sub_names, valid_flairs, debug_level='NOTICE', progr
             sub_flairs[key]['other_flair'] = other_flair
 
             if flair['flair_text'] is not None and flair['flair_text'] != '':
-                sub_flairs[key]['flair_text'] = flair['flair_text'].encode('utf-8')
+                sub_flairs[key]['flair_text'] = flair['flair_text']
             else:
                 sub_flairs[key]['flair_text'] = ''
 
             if debug_level == 'DEBUG':
                 print('[{}] [DEBUG] Retrieving from /r/{} ({}) User: {} has flair class: {} and flair text: \'{}\''
                         .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), sub_name, index, flair['user'],
-                            flair['flair_css_class'], sub_flairs[flair[key]]['flair_text']))
+                            flair['flair_css_class'], sub_flairs[key]['flair_text']))
 
         if progress is True and (debug_level == 'NOTICE' or debug_level == 'DEBUG'):
             sys.stdout.write('\n')
@@ -106,17 +140,17 @@ def reddit_get_all_flair(r, sub_names, valid_flairs, debug_level='NOTICE', progr
     return flairs
 
 
-# set flairs via update
+# set flairs via update, returning True if reddit accepted the update
 def reddit_set_flair(r, sub_name, flairs, sync_flairs='y', debug_level='NOTICE'):
     if sync_flairs == 'n' or debug_level == 'NOTICE' or debug_level == 'DEBUG':
         for flair in flairs:
             print('[{}] [NOTICE] In /r/{}, setting flair for User: {}, flair: {}, flair_text: {}'
-                  .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), sub_name, flair['user'], flair['flair_css_class'], flair['flair_text'].encode('utf-8')))
+                  .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), sub_name, flair['user'], flair['flair_css_class'], flair['flair_text']))
 
     # confirm operation or proceed if automatic
     if sync_flairs == 'n':
         print('Sync {} flair(s) to /r/{}?'.format(len(flairs), sub_name))
-        sync_flairs = raw_input('(y/n) ')
+        sync_flairs = input('(y/n) ')
     else:
         print('[{}] Syncing {} flair(s) to /r/{}'
               .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), len(flairs), sub_name))
@@ -129,6 +163,8 @@ def reddit_set_flair(r, sub_name, flairs, sync_flairs='y', debug_level='NOTICE')
             if response[0]['ok'] is True:
                 print('[{}] Updating {} flair(s) to /r/{} successful!'
                       .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), len(flairs), sub_name))
+
+                return True
             else:
                 sys.stderr.write('[{}] [ERROR]: Error updating flair: {}\n'
                                  .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), response[0]['status']))
@@ -137,6 +173,8 @@ def reddit_set_flair(r, sub_name, flairs, sync_flairs='y', debug_level='NOTICE')
             sys.stderr.write('[{}] [ERROR]: Error updating flair: {}\n'
                              .format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), e))
 
+    return False
+
 
 ###
 # Post helpers